@@ -4,19 +4,121 @@ import numpy as np
 from scipy import signal
 import os
 import glob
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import tkinter as tk
 from tkinter import filedialog
 import matplotlib.pyplot as plt
 
+_TK_ROOT = None  # Hidden Tk root shared by all file dialogs, created on first use
+
+
+def _get_tk_root():
+    """Return hidden Tk root for file dialogs, creating it on first call"""
+    global _TK_ROOT
+    if _TK_ROOT is None:
+        _TK_ROOT = tk.Tk()
+        _TK_ROOT.withdraw()
+    return _TK_ROOT
+
+
+@lru_cache()
+def _make_filter(order, cutoff):
+    """Design high-pass Butterworth filter as second-order sections, cached so workers share the same design
+    Returned as nested tuples so the shared design cannot be modified; sosfilt needs a writable array, so convert
+    with np.array() before filtering"""
+    return tuple(map(tuple, signal.butter(order, cutoff, btype='highpass', output='sos')))
+
+
+@lru_cache()
+def _make_poly_basis(start_pix, end_pix, poly_order):
+    """Generate orthonormal polynomial basis over pixels start_pix to end_pix, cached on window and polynomial order
+    Fitting window is fixed between retrievals, so its Vandermonde matrix is factorised once here rather than
+    letting np.polyfit re-solve it on every call"""
+    fit_pix = np.arange(start_pix, end_pix, dtype=np.float64)  # Pixel values across fitting window
+    poly_basis, _ = np.linalg.qr(np.vander(fit_pix, poly_order + 1))
+    poly_basis.flags.writeable = False  # Shared between callers, so protect from modification
+    return poly_basis
+
+
+def _closest_pix(wavelengths, wave, is_sorted):
+    """Find index of the value in wavelengths closest to wave
+    If wavelengths is strictly increasing (is_sorted), as for calibrated wavelengths, this is found by binary search,
+    otherwise a full search is used"""
+    if is_sorted:
+        pix = int(np.searchsorted(wavelengths, wave))
+        if pix == len(wavelengths) or (pix > 0 and wave - wavelengths[pix - 1] <= wavelengths[pix] - wave):
+            pix -= 1  # Lower neighbour is closer (or wave lies beyond the last wavelength)
+        return pix
+    return int(np.argmin(np.abs(wavelengths - wave)))
+
+
+def _remove_poly(spec_cuts, poly_basis):
+    """Remove polynomial fit from spectrum, or from each row of a (number of spectra, N) array of spectra"""
+    return spec_cuts - (spec_cuts @ poly_basis) @ poly_basis.T
+
+
+def _fit_column_amount(abs_cuts, ref_cut, vals_ca):
+    """Find column amount in vals_ca which minimises MSE of fitting ref_cut * i to abs_cuts, where abs_cuts is a
+    single spectrum or a (number of spectra, N) array of spectra
+    MSE is quadratic in the column amount, a - 2*b*i + c*i^2, so its minimum is found analytically at b/c. The MSE
+    is symmetric about b/c, so the value in vals_ca (which must be increasing) closest to b/c fits best on that grid
+    Returns index (or indices) of best fitting column amount in vals_ca, and b and c of the quadratic"""
+    b = (abs_cuts @ ref_cut) / len(ref_cut)
+    c = np.dot(ref_cut, ref_cut) / len(ref_cut)
+    if not c > 0:
+        raise ValueError('Cannot fit column amount: reference spectrum is zero or not finite across the fitting window')
+    column_amounts = b / c
+    invalid = ~np.isfinite(column_amounts)
+    if np.any(invalid):
+        if np.ndim(invalid):
+            raise ValueError('Cannot fit column amount: absorbance is not finite across the fitting window for '
+                             'spectra {} (check plume spectra)'.format(np.flatnonzero(invalid).tolist()))
+        raise ValueError('Cannot fit column amount: absorbance is not finite across the fitting window '
+                         '(check plume spectrum)')
+    if not np.all(np.diff(vals_ca) > 0):
+        raise ValueError('Cannot fit column amount: vals_ca must be strictly increasing')
+    if len(vals_ca) == 1:
+        return np.zeros(np.shape(column_amounts), dtype=int), b, c
+    min_idx = np.clip(np.searchsorted(vals_ca, column_amounts), 1, len(vals_ca) - 1)
+    min_idx -= column_amounts - vals_ca[min_idx - 1] <= vals_ca[min_idx] - column_amounts  # Lower value is closer
+    return min_idx, b, c
+
+
+def _doas_search(abs_cut, ref_cut, vals_ca, poly_basis=None, mse_vals=None):
+    """Find column amount i in vals_ca which minimises MSE of fitting ref_cut * i to abs_cut
+    If poly_basis is given, the polynomial fit to the residual is removed before calculating the MSE
+    Returns index of the best fitting column amount in vals_ca and MSE values for all of vals_ca, written into
+    mse_vals if it is provided"""
+    if poly_basis is not None:
+        # Residual after polynomial fit is linear in the column amount, so project the absorbance and reference
+        # spectra off the polynomial basis once rather than for every column amount. Both are projected together
+        # in a single pair of matrix products
+        abs_cut, ref_cut = _remove_poly(np.vstack((abs_cut, ref_cut)), poly_basis)
+
+    (min_idx, b, c) = _fit_column_amount(abs_cut, ref_cut, vals_ca)
+    a = np.dot(abs_cut, abs_cut) / len(abs_cut)
+
+    # Kept for plotting MSE against column amount, evaluated as (c*i - 2*b)*i + a in place
+    if mse_vals is None:
+        mse_vals = np.empty(len(vals_ca))
+    np.multiply(vals_ca, c, out=mse_vals)
+    mse_vals -= 2 * b
+    mse_vals *= vals_ca
+    mse_vals += a
+    return int(min_idx), mse_vals
+
+
 class DOASWorker:
     """Class to control DOAS processing
     General order of play for processing:
     Initiate class,
     get_ref_spectrum()
     set_fit_window()
-    shift_spectrum"""
-    def __init__(self, routine):
+    shift_spectrum
+    If img_path or dark_dir are not given, the user is asked to select them through a file dialog"""
+    def __init__(self, routine, img_path=None, dark_dir=None):
         self.routine = routine  # Defines routine to be used, either (1) Polynomial or (2) Digital Filtering
 
         # ======================================================================================================================
@@ -31,12 +133,14 @@ class DOASWorker:
         self.end_fit_wave = 320  # Wavelength space fitting window definitions
         self.fit_window = None  # Fitting window, determined by set_fit_window()
         self.fit_window_ref = None  # Placeholder for shifted fitting window for the reference spectrum
+        self.poly_basis = None  # Orthonormal polynomial basis over fitting window, determined by update_poly_basis()
         self.wave_fit = True  # If True, wavelength parameters are used to define fitting window
 
         self.wavelengths = None  # Placeholder for wavelengths attribute which contains all wavelengths of spectra
 
         self.poly_order = 2  # Order of polynomial used to fit residual
-        (self.filt_B, self.filt_A) = signal.butter(10, 0.065, btype='highpass')
+        self.filt_order = 10  # Order of high-pass Butterworth filter used in digital filtering
+        self.filt_cutoff = 0.065  # Critical frequency of high-pass filter (as fraction of Nyquist frequency)
 
         self.start_ca = 0  # Starting column amount for iterations
         self.end_ca = 2000  # Ending column amount for iterations
@@ -48,10 +152,11 @@ class DOASWorker:
 
         # --------------------------------------------------------------------------------------------------------------
         # GENERATE CLEAR SPECTRUM AND LOAD DARK IMAGE
-        (self.img_clear, self.img_size_x, self.img_size_y) = self.load_img()  # Clear image (I0)
-        self.img_dark = self.load_dark()  # Dark Image
+        (self.img_clear, self.img_size_x, self.img_size_y) = self.load_img(img_path)  # Clear image (I0)
+        self.img_dark = self.load_dark(dark_dir)  # Dark Image
         self.img_clear = self.img_clear - self.img_dark  # Dark subtract clear image
-        self.clear_spec = np.mean(self.img_clear[self.row_range, :])
+        self.clear_spec = np.mean(self.img_clear[self.row_range, :], axis=0).astype(np.float32, copy=False)  # Average rows to give 1D spectrum
+        self.abs_buf = np.empty_like(self.clear_spec)  # Buffer which absorbance spectrum is calculated into
         # --------------------------------------------------------------------------------------------------------------
 
     def get_ref_spectrum(self):
@@ -67,98 +172,136 @@ class DOASWorker:
             if self.wavelengths is None:
                 print('Error, first run get_ref_spectrum() to define wavelengths vector')
                 return
-            wave_dif_start = self.wavelengths - self.start_fit_wave
-            wave_dif_end = self.wavelengths - self.end_fit_wave
-            self.start_fit_pix = wave_dif_start.index(np.amin(wave_dif_start))  # Find the index which represents the wavelengths closest to the defined starting wavelength for the fit
-            self.end_fit_pix = wave_dif_end.index(np.amin(wave_dif_end))  # As above, but for ending wavelength
+            # Check once for the wavelengths currently in use whether they can be binary searched for both ends
+            is_sorted = bool(np.all(np.diff(self.wavelengths) > 0))
+            self.start_fit_pix = _closest_pix(self.wavelengths, self.start_fit_wave, is_sorted)  # Find the index which represents the wavelengths closest to the defined starting wavelength for the fit
+            self.end_fit_pix = _closest_pix(self.wavelengths, self.end_fit_wave, is_sorted)  # As above, but for ending wavelength
 
-        self.fit_window = np.arange(self.start_fit_pix, self.end_fit_pix)  # Fitting window (in Pixel space)
+        self.fit_window = slice(self.start_fit_pix, self.end_fit_pix)  # Fitting window (in Pixel space), as a slice so spectra are cut as views
+        self.update_poly_basis()
+
+    def update_poly_basis(self):
+        """Look up polynomial basis for current fitting window and poly_order
+        Called by every polynomial retrieval, so changes to poly_order are picked up without re-running
+        set_fit_window(). Bases are cached, so this is cheap"""
+        self.poly_basis = _make_poly_basis(self.fit_window.start, self.fit_window.stop, self.poly_order)
+        return self.poly_basis
 
     def shift_spectrum(self):
         """Shift fitting window for reference spectrum"""
-        self.fit_window_ref = self.fit_window - self.shift  # Shifting the fitting window indices for the ref spectrum
+        self.fit_window_ref = slice(self.fit_window.start - self.shift, self.fit_window.stop - self.shift)  # Shifting the fitting window for the ref spectrum
 
-    def load_img(self):
+    def load_img(self, img_path=None):
         """Load img"""
-        root = tk.Tk()
-        root.withdraw()
-        img_path = filedialog.askopenfilename(**self.filetypes)  # Get user to find clear image
+        if img_path is None:
+            img_path = filedialog.askopenfilename(parent=_get_tk_root(), **self.filetypes)  # Get user to find clear image
         img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)  # Read in clear image
+        if img is None:
+            raise OSError('Could not read image: {}'.format(img_path))
         size_y, size_x = np.shape(img)  # Define image dimensions
         return img, size_x, size_y
 
-    def load_dark(self):
+    def load_dark(self, dark_dir=None):
         """Load drk images -> co-add to generate single dark image"""
-        dark_dir_path = filedialog.askdirectory()
-        dark_dir_path += '/*.png'
-        dark_list = glob.glob(dark_dir_path)   # List all .png files in dark directory
-        num_dark_imgs = len(dark_list)
-        dark_array = np.zeros([self.img_size_y, self.img_size_x, num_dark_imgs])
-        for i in range(num_dark_imgs):
-            dark_array[:, :, i] = cv2.imread(dark_dir_path + '/' + dark_list[i], cv2.IMREAD_UNCHANGED)
-        img_dark = np.mean(dark_array, 2)
+        if dark_dir is None:
+            dark_dir = filedialog.askdirectory(parent=_get_tk_root())  # Get user to find dark image directory
+        dark_list = glob.glob(os.path.join(dark_dir, '*.png'))   # List all .png files in dark directory
+        if not dark_list:
+            raise FileNotFoundError('No .png dark images found in directory: {}'.format(dark_dir))
+        dark_sum = np.zeros([self.img_size_y, self.img_size_x], dtype=np.uint32)  # Integer sum, so no per-image float conversion
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:  # cv2 releases the GIL while decoding
+            for dark_path, img in zip(dark_list, executor.map(lambda path: cv2.imread(path, cv2.IMREAD_UNCHANGED),
+                                                              dark_list)):
+                if img is None:
+                    raise OSError('Could not read dark image: {}'.format(dark_path))
+                np.add(dark_sum, img, out=dark_sum)  # Co-add each image as it is read
+        img_dark = np.divide(dark_sum, len(dark_list), dtype=np.float32)
         return img_dark
 
+    def calc_abs_spec(self):
+        """Calculate absorbance spectrum from clear and plume spectra, in place in abs_buf"""
+        np.divide(self.clear_spec, self.plume_spec, out=self.abs_buf)
+        np.log(self.abs_buf, out=self.abs_buf)
+        self.abs_spec = self.abs_buf
+
     def poly_DOAS(self):
         """Performs main processing in polynomial fitting DOAS retrieval"""
 
-        self.abs_spec = np.log(np.divide(self.clear_spec, self.plume_spec))  # Calculate absorbance
+        self.calc_abs_spec()  # Calculate absorbance
         self.ref_spec_cut = self.ref_spec[self.fit_window_ref]
         self.abs_spec_cut = self.abs_spec[self.fit_window]
 
-        idx = 0
-        for i in self.vals_ca:
-            ref_spec_fit = self.ref_spec_cut * i  # Our iterative guess at the SO2 column density
-            residual = self.abs_spec_cut - ref_spec_fit  # Calculate resultant residual from spectrum fitting
-            poly_fit = np.polyfit(self.fit_window, residual, self.poly_order)  # Fit polynomial to residual
-            poly_vals = np.polyval(poly_fit, self.fit_window)  # Generate polynomial values for fitting window
-
-            self.mse_vals[idx] = np.mean(np.power(residual - poly_vals, 2))  # Calculate MSE of fit
-
-            idx += 1
-
-        self.min_idx = np.argmin(self.mse_vals)
+        (self.min_idx, self.mse_vals) = _doas_search(self.abs_spec_cut, self.ref_spec_cut, self.vals_ca,
+                                                     self.update_poly_basis(), self.mse_vals)
         self.column_amount = self.vals_ca[self.min_idx]
 
+    def poly_DOAS_batch(self, plume_specs):
+        """Performs polynomial fitting DOAS retrieval on many plume spectra at once
+        plume_specs is array of shape (number of spectra, img_size_x), or a single spectrum of shape (img_size_x,).
+        Column amount of each spectrum is found analytically, as in poly_DOAS, and stored in column_amounts. Raises
+        ValueError if any spectrum cannot be fitted"""
+        plume_specs = np.atleast_2d(plume_specs)
+        if plume_specs.ndim != 2 or plume_specs.shape[1] != len(self.clear_spec):
+            raise ValueError('plume_specs must have shape (number of spectra, {}), got {}'.format(
+                len(self.clear_spec), plume_specs.shape))
+        abs_specs = np.log(self.clear_spec / plume_specs)  # Calculate absorbance of every spectrum
+        abs_cut = abs_specs[:, self.fit_window]
+        ref_cut = self.ref_spec[self.fit_window_ref]
+
+        # Project all absorbance spectra and the reference off the polynomial basis together, then take best fit
+        # column amount of each
+        resid = _remove_poly(np.vstack((abs_cut, ref_cut)), self.update_poly_basis())
+        (min_idx, _, _) = _fit_column_amount(resid[:-1], resid[-1], self.vals_ca)
+        self.column_amounts = self.vals_ca[min_idx]
+
     def fltr_DOAS(self):
         """Performs main retrieval in digital filtering DOAS retrieval"""
-        self.abs_spec = np.log(np.divide(self.clear_spec, self.plume_spec))  # Calculate absorbance
-        self.abs_spec_filt = signal.lfilter(self.filt_B, self.filt_A, self.abs_spec)  # Filter absorbance spectrum
-
-        self.ref_spec_cut = self.ref_spec[self.fit_window_ref]
-        self.abs_spec_cut = self.abs_spec[self.fit_window]
-
-        idx = 1
-        for i in self.vals_ca:
-            ref_spec_fit = self.ref_spec_cut * i
+        self.calc_abs_spec()  # Calculate absorbance
+        filt_sos = np.array(_make_filter(self.filt_order, self.filt_cutoff))
+        self.abs_spec_filt = signal.sosfilt(filt_sos, self.abs_spec)  # Filter absorbance spectrum
+        self.ref_spec_filt = signal.sosfilt(filt_sos, self.ref_spec)  # Filter reference spectrum in the same way
 
-            self.mse_vals[idx] = np.mean(np.power(self.abs_spec_cut, ref_spec_fit, 2))  # Calculate MSE of fit
-            idx += 1
+        self.ref_spec_cut = self.ref_spec_filt[self.fit_window_ref]
+        self.abs_spec_cut = self.abs_spec_filt[self.fit_window]
 
-        self.min_idx = np.argmin(self.mse_vals)
+        (self.min_idx, self.mse_vals) = _doas_search(self.abs_spec_cut, self.ref_spec_cut, self.vals_ca,
+                                                     mse_vals=self.mse_vals)
         self.column_amount = self.vals_ca[self.min_idx]
 
 
 
-    def poly_plot_gen(self):
+    def _compute_plot_arrays(self):
         """Generate arrays to be plotted -> residual, fitted spectrum"""
         self.ref_spec_fit = self.ref_spec_cut * self.column_amount
         self.residual = self.abs_spec_cut - self.ref_spec_fit
-        poly_fit = np.polyfit(self.fit_window, self.residual, self.poly_order)  # Fit polynomial to residual
-        self.poly_vals = np.polyval(poly_fit, self.fit_window)  # Generate polynomial values for fitting window
+        poly_basis = self.update_poly_basis()
+        self.poly_vals = poly_basis @ (poly_basis.T @ self.residual)  # Polynomial fit to residual
         self.best_fit = self.ref_spec_fit + self.poly_vals  # Generate best fit absorbance spectrum
-
-        # MAKE PLOT
-        plt.figure()
-        abs_plt, = plt.plot(self.abs_spec_cut, label='Absorbance spectrum')
-        ref_plt, = plt.plot(self.ref_spec_fit, label='Reference spectrum * CA')
-        res_plt, = plt.plot(self.residual, label='Residual')
-        poly_plt, = plt.plot(self.poly_vals, label='Polynomial fit')
-        best_plt, = plt.plot(self.best_fit, label='Best fit')
-        plt.xlabel('Pixel')
-        plt.ylabel('Absorbance')
-        plt.legend(handles=[abs_plt, ref_plt, res_plt, poly_plt, best_plt])
-        plt.show()
+        return {'Absorbance spectrum': self.abs_spec_cut,
+                'Reference spectrum * CA': self.ref_spec_fit,
+                'Residual': self.residual,
+                'Polynomial fit': self.poly_vals,
+                'Best fit': self.best_fit}
+
+    @staticmethod
+    def _draw_plot(arrays, ax=None):
+        """Plot arrays from _compute_plot_arrays() on ax, or on a new pyplot figure if ax is None
+        Rendering is left to the caller, and new figures are not closed here: call plt.show() to display them, and
+        plt.close(ax.figure) once finished with them, otherwise pyplot keeps every figure open"""
+        if ax is None:
+            _, ax = plt.subplots()
+        for label, vals in arrays.items():
+            ax.plot(vals, label=label)
+        ax.set_xlabel('Pixel')
+        ax.set_ylabel('Absorbance')
+        ax.legend()
+        return ax
+
+    def poly_plot_gen(self, ax=None):
+        """Generate and plot residual and fitted spectrum
+        Plot is drawn on ax if given, otherwise on a new figure which the caller is responsible for showing and
+        closing (see _draw_plot())"""
+        return self._draw_plot(self._compute_plot_arrays(), ax)
 
 
 
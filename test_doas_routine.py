@@ -0,0 +1,213 @@
+# Tests for DOAS retrievals in doas_routine.py, run with pytest
+
+import cv2
+import numpy as np
+import pytest
+
+from scipy import signal
+
+import doas_routine
+from doas_routine import DOASWorker, _closest_pix, _make_filter, _make_poly_basis
+
+
+def make_worker(seed=0, size_x=600):
+    """Generate DOASWorker with random clear and reference spectra, bypassing image loading in __init__"""
+    rng = np.random.default_rng(seed)
+    worker = DOASWorker.__new__(DOASWorker)
+    worker.vals_ca = np.arange(0, 2001)
+    worker.mse_vals = np.zeros(len(worker.vals_ca))
+    worker.poly_order = 2
+    worker.filt_order = 10
+    worker.filt_cutoff = 0.065
+    worker.start_fit_pix = 275
+    worker.end_fit_pix = 400
+    worker.shift = 2
+    worker.fit_window = slice(worker.start_fit_pix, worker.end_fit_pix)
+    worker.fit_window_ref = slice(worker.start_fit_pix - worker.shift, worker.end_fit_pix - worker.shift)
+    worker.poly_basis = _make_poly_basis(worker.start_fit_pix, worker.end_fit_pix, worker.poly_order)
+    worker.ref_spec = rng.random(size_x) * 1e-3
+    worker.clear_spec = (rng.random(size_x) * 100 + 1000).astype(np.float32)
+    worker.abs_buf = np.empty_like(worker.clear_spec)
+    return worker, rng
+
+
+def test_poly_DOAS_batch_matches_poly_DOAS():
+    worker, rng = make_worker()
+    plume_specs = worker.clear_spec * np.exp(-rng.random((50, len(worker.clear_spec))) * 0.5)
+
+    worker.poly_DOAS_batch(plume_specs)
+    column_amounts = []
+    for plume_spec in plume_specs:
+        worker.plume_spec = plume_spec
+        worker.poly_DOAS()
+        column_amounts.append(worker.column_amount)
+
+    np.testing.assert_array_equal(worker.column_amounts, column_amounts)
+
+
+def test_poly_DOAS_batch_single_spectrum():
+    worker, rng = make_worker(seed=6)
+    worker.plume_spec = worker.clear_spec * np.exp(-rng.random(len(worker.clear_spec)) * 0.5)
+    worker.poly_DOAS()
+
+    worker.poly_DOAS_batch(worker.plume_spec)
+    np.testing.assert_array_equal(worker.column_amounts, [worker.column_amount])
+
+    with pytest.raises(ValueError, match='plume_specs must have shape'):
+        worker.poly_DOAS_batch(worker.plume_spec[:-1])
+
+
+def test_poly_DOAS_matches_polyfit_scan():
+    worker, rng = make_worker(seed=1)
+    worker.plume_spec = worker.clear_spec * np.exp(-worker.ref_spec * 300 - rng.random(len(worker.clear_spec)) * 1e-2)
+    worker.poly_DOAS()
+
+    fit_pix = np.arange(worker.start_fit_pix, worker.end_fit_pix)
+    mse_vals = []
+    for i in worker.vals_ca:
+        residual = worker.abs_spec_cut - worker.ref_spec_cut * i
+        poly_vals = np.polyval(np.polyfit(fit_pix, residual, worker.poly_order), fit_pix)
+        mse_vals.append(np.mean((residual - poly_vals) ** 2))
+
+    assert worker.column_amount == worker.vals_ca[np.argmin(mse_vals)]
+    np.testing.assert_allclose(worker.mse_vals, mse_vals, atol=1e-12)
+
+
+@pytest.mark.parametrize('vals_ca', [np.arange(0, 2001), np.arange(0, 2001, 7), np.linspace(100.5, 500, 37),
+                                     np.array([5.])])
+def test_poly_DOAS_column_amount_on_grid(vals_ca):
+    worker, rng = make_worker(seed=7)
+    worker.vals_ca = vals_ca
+    worker.mse_vals = np.zeros(len(vals_ca))
+    for _ in range(50):
+        worker.plume_spec = worker.clear_spec * np.exp(-worker.ref_spec * rng.uniform(-200, 2500)
+                                                       - rng.random(len(worker.clear_spec)) * 1e-2)
+        worker.poly_DOAS()
+        assert worker.min_idx == np.argmin(worker.mse_vals)
+        assert worker.column_amount == vals_ca[worker.min_idx]
+
+
+def test_poly_DOAS_invalid_input_raises():
+    worker, rng = make_worker(seed=2)
+    worker.plume_spec = worker.clear_spec * np.exp(-rng.random(len(worker.clear_spec)) * 0.5)
+    worker.plume_spec[worker.start_fit_pix + 10] = -1  # Non-positive ratio gives NaN absorbance in fitting window
+    with pytest.warns(RuntimeWarning), pytest.raises(ValueError, match='absorbance is not finite'):
+        worker.poly_DOAS()
+
+    worker.plume_spec = worker.clear_spec * np.exp(-rng.random(len(worker.clear_spec)) * 0.5)
+    worker.ref_spec = np.zeros(len(worker.ref_spec))
+    with pytest.raises(ValueError, match='reference spectrum is zero'):
+        worker.poly_DOAS()
+
+    worker, _ = make_worker(seed=2)
+    worker.plume_spec = worker.clear_spec * np.exp(-rng.random(len(worker.clear_spec)) * 0.5)
+    worker.vals_ca = worker.vals_ca[::-1].copy()
+    with pytest.raises(ValueError, match='strictly increasing'):
+        worker.poly_DOAS()
+
+
+def test_poly_DOAS_uses_current_poly_order():
+    worker, rng = make_worker(seed=3)
+    worker.plume_spec = worker.clear_spec * np.exp(-rng.random(len(worker.clear_spec)) * 0.5)
+    worker.poly_order = 4  # Changed after fitting window (and its basis) was set up
+    worker.poly_DOAS()
+
+    assert worker.poly_basis.shape == (worker.end_fit_pix - worker.start_fit_pix, 5)
+    fit_pix = np.arange(worker.start_fit_pix, worker.end_fit_pix)
+    i = worker.column_amount
+    residual = worker.abs_spec_cut - worker.ref_spec_cut * i
+    poly_vals = np.polyval(np.polyfit(fit_pix, residual, 4), fit_pix)
+    np.testing.assert_allclose(worker.mse_vals[worker.min_idx], np.mean((residual - poly_vals) ** 2), atol=1e-12)
+
+
+def test_fltr_DOAS_recovers_column_amount():
+    worker, rng = make_worker(seed=4)
+    pix = np.arange(len(worker.clear_spec))
+    broadband = 0.05 + 1e-4 * pix  # Slowly varying extinction, removed by the high-pass filter
+    worker.plume_spec = worker.clear_spec * np.exp(-(worker.ref_spec * 850 + broadband))
+    worker.shift = 0
+    worker.fit_window_ref = worker.fit_window
+    worker.fltr_DOAS()
+
+    assert worker.column_amount == 850
+
+    filt_sos = np.array(_make_filter(worker.filt_order, worker.filt_cutoff))
+    abs_filt = signal.sosfilt(filt_sos, np.log(worker.clear_spec / worker.plume_spec))[worker.fit_window]
+    ref_filt = signal.sosfilt(filt_sos, worker.ref_spec)[worker.fit_window_ref]
+    mse_vals = [np.mean((abs_filt - i * ref_filt) ** 2) for i in worker.vals_ca]
+    np.testing.assert_allclose(worker.mse_vals, mse_vals, rtol=1e-4, atol=1e-12)
+
+
+def test_poly_DOAS_batch_invalid_spectrum_raises():
+    worker, rng = make_worker(seed=2)
+    plume_specs = worker.clear_spec * np.exp(-rng.random((5, len(worker.clear_spec))) * 0.5)
+    plume_specs[3, worker.start_fit_pix + 10] = -1  # Non-positive ratio gives NaN absorbance in fitting window
+
+    with pytest.warns(RuntimeWarning), pytest.raises(ValueError, match=r'\[3\]'):
+        worker.poly_DOAS_batch(plume_specs)
+
+
+@pytest.mark.parametrize('is_sorted', [True, False])
+def test_closest_pix_matches_argmin(is_sorted):
+    rng = np.random.default_rng(5)
+    wavelengths = np.sort(rng.uniform(280, 420, 2048))
+    for wave in np.concatenate((rng.uniform(250, 450, 500), wavelengths[:20], [250, 450])):  # Includes values out of range
+        assert _closest_pix(wavelengths, wave, is_sorted) == np.argmin(np.abs(wavelengths - wave))
+
+
+def test_closest_pix_ties_and_range():
+    wavelengths = np.array([300., 301., 302., 303.])
+    assert _closest_pix(wavelengths, 301.5, True) == 1  # Tie goes to the lower pixel, as with argmin
+    assert _closest_pix(wavelengths, 301.5, False) == 1
+    assert _closest_pix(wavelengths, 290., True) == 0
+    assert _closest_pix(wavelengths, 310., True) == 3
+
+
+def test_set_fit_window_from_wavelengths(monkeypatch):
+    sorted_flags = []
+
+    def spy_closest_pix(wavelengths, wave, is_sorted):
+        sorted_flags.append(is_sorted)
+        return _closest_pix(wavelengths, wave, is_sorted)
+
+    monkeypatch.setattr(doas_routine, '_closest_pix', spy_closest_pix)
+    worker, _ = make_worker()
+    worker.wave_fit = True
+    worker.start_fit_wave, worker.end_fit_wave = 305, 320
+    worker.wavelengths = np.linspace(300, 330, 600)
+    worker.set_fit_window()
+    assert (worker.start_fit_pix, worker.end_fit_pix) == (100, 399)
+    assert sorted_flags == [True, True]
+
+    worker.wavelengths = worker.wavelengths[::-1].copy()  # Unsorted wavelengths fall back to full search
+    worker.set_fit_window()
+    assert (worker.start_fit_pix, worker.end_fit_pix) == (499, 200)
+    assert sorted_flags[2:] == [False, False]
+
+
+def test_load_img_and_dark(tmp_path):
+    img = np.full((20, 30), 1000, dtype=np.uint16)
+    cv2.imwrite(str(tmp_path / 'clear.png'), img)
+    dark_dir = tmp_path / 'dark'
+    dark_dir.mkdir()
+    for i, val in enumerate([10, 20, 31]):
+        cv2.imwrite(str(dark_dir / 'dark_{}.png'.format(i)), np.full((20, 30), val, dtype=np.uint16))
+
+    worker = DOASWorker.__new__(DOASWorker)
+    (img_clear, worker.img_size_x, worker.img_size_y) = worker.load_img(str(tmp_path / 'clear.png'))
+    np.testing.assert_array_equal(img_clear, img)
+    assert (worker.img_size_x, worker.img_size_y) == (30, 20)
+    np.testing.assert_allclose(worker.load_dark(str(dark_dir)), np.full((20, 30), 61 / 3))
+
+
+def test_load_img_and_dark_bad_paths_raise(tmp_path):
+    worker = DOASWorker.__new__(DOASWorker)
+    worker.img_size_x, worker.img_size_y = 30, 20
+    with pytest.raises(OSError, match='Could not read image'):
+        worker.load_img(str(tmp_path / 'missing.png'))
+    with pytest.raises(FileNotFoundError, match='No .png dark images'):
+        worker.load_dark(str(tmp_path / 'missing_dir'))
+
+    (tmp_path / 'corrupt.png').write_bytes(b'not a png')
+    with pytest.raises(OSError, match='Could not read dark image'):
+        worker.load_dark(str(tmp_path))